@@ -1,10 +1,10 @@
-import asyncio
 import logging
 
 from aiohttp import web
-from discord.ext import tasks
 from preston import Preston
 
+from contacts import contact_jobs
+from esi import call_esi, forget_character, use_pool
 from models import User, Character, Challenge
 
 # Configure the logger
@@ -12,13 +12,9 @@ logger = logging.getLogger('callback')
 logger.setLevel(logging.INFO)
 
 
-@tasks.loop()
 async def callback_server(preston: Preston, add_contacts):
     routes = web.RouteTableDef()
 
-    async def async_add_contacts(character):
-        add_contacts(character, preston)
-
     @routes.get('/')
     async def hello(request):
         return web.Response(text="Contacts Bot Callback Server")
@@ -37,15 +33,15 @@ async def callback_server(preston: Preston, add_contacts):
 
         # Authenticate using the code
         try:
-            auth = preston.authenticate(code)
+            auth = use_pool(await call_esi(preston.authenticate, code))
         except Exception as e:
             logger.error(e)
             logger.warning("Failed to verify token")
             return web.Response(text="Authentication failed!", status=403)
 
         # Get character data
-        character_data = auth.whoami()
-        character_id = character_data["character_id"]
+        character_data = await call_esi(auth.whoami)
+        character_id = str(character_data["character_id"])
         character_name = character_data["character_name"]
 
         # Create / Update user and store refresh_token
@@ -56,12 +52,15 @@ async def callback_server(preston: Preston, add_contacts):
 
         character, created = Character.get_or_create(
             character_id=character_id, user=user,
-            defaults={"token": auth.refresh_token}
+            defaults={"token": auth.refresh_token, "character_name": character_name}
         )
         character.token = auth.refresh_token
+        character.character_name = character_name
+        character.token_alive = True
         character.save()
+        forget_character(character_id)
 
-        asyncio.create_task(async_add_contacts(character))
+        await contact_jobs.put(add_contacts(character, preston))
 
         logger.info(f"Added character {character_id}")
         if created:
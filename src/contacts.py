@@ -1,9 +1,13 @@
+import asyncio
 import logging
 import os
+import time
 
+from discord.ext import tasks
 from preston import Preston
 from requests.exceptions import HTTPError
 
+from esi import authenticate_character, forget_character, token_revoked, call_esi
 from models import Character, ExternalContact
 
 logger = logging.getLogger("discord.main.contacts")
@@ -14,145 +18,226 @@ if BOT_STANDING in [-10, -5, 0, 5, 10]:
     logger.error("The standing value must not be a value able to set by players.")
     exit(1)
 
+# ESI standings have two decimals, so comparing them in hundredths is exact
+BOT_STANDING_CENTS = round(BOT_STANDING * 100)
 
-def add_character_contacts(preston: Preston, character_id: str, contacts_to_add: set[str]):
-    """Add contracts for a character while not overwriting existing contracts"""
+# ESI caches contact lists for 5 minutes, fetching them again before that returns the same data
+CONTACTS_CACHE_TTL = 300
+
+_standings_cache: dict[str, tuple[float, dict[int, float]]] = {}
+
+# Contact updates are run one after another in the background, so that commands and the
+# callback only wait for the job to be queued and updates never race each other
+contact_jobs = asyncio.Queue()
+
+# Columns needed to authenticate a character without loading the whole row
+TOKEN_COLUMNS = (Character.character_id, Character.token, Character.access_token, Character.access_token_expiry)
+
+# Most contact ids ESI accepts in a single POST and DELETE request
+MAX_CONTACTS_PER_POST = 100
+MAX_CONTACTS_PER_DELETE = 20
+
+# External contacts change rarely, so their ids are loaded once and then kept up to date in memory
+_external_ids_cache: set[int] | None = None
+
+
+def get_external_ids() -> set[int]:
+    """Get the ids of all external contacts, loading them from the database only when needed."""
+    global _external_ids_cache
+    if _external_ids_cache is None:
+        _external_ids_cache = {
+            int(external_contact.contact_id) for external_contact in
+            ExternalContact.select(ExternalContact.contact_id)
+        }
+    return _external_ids_cache
+
+
+def get_character_standings(preston: Preston, character_id: str) -> dict[int, float]:
+    """Get the standings of a character's contacts by contact id, reusing a recently fetched list.
+
+    The bot's own writes are applied to the cached standings, since ESI would keep serving the
+    list from before the write until its cache expires.
+    """
+    cached = _standings_cache.get(character_id)
+    if cached is not None and time.monotonic() - cached[0] < CONTACTS_CACHE_TTL:
+        return cached[1]
 
     contacts = preston.get_op(
         "get_characters_character_id_contacts",
-        character_id=str(character_id)
+        character_id=character_id
     )
+    standings = {c['contact_id']: c['standing'] for c in contacts}
+    _standings_cache[character_id] = (time.monotonic(), standings)
+    return standings
+
 
-    existing_contracts = {str(c['contact_id']) for c in contacts if c.get('standing') > BOT_STANDING}
-    contacts_to_add -= existing_contracts
+def chunks(contact_ids: set[int], size: int) -> list[list[int]]:
+    """Split contact ids into sorted lists of at most size ids, so equal sets give equal requests."""
+    contact_ids = sorted(contact_ids)
+    return [contact_ids[i:i + size] for i in range(0, len(contact_ids), size)]
 
-    if len(contacts_to_add) == 0:
+
+def add_character_contacts(preston: Preston, character_id: str, contacts_to_add: set[int]):
+    """Add contracts for a character while not overwriting existing contracts"""
+    if not contacts_to_add:
         return
 
-    preston.post_op(
-        'post_characters_character_id_contacts',
-        path_data={
-            "character_id": character_id,
-            "standing": BOT_STANDING,
-            "watched": False,
-        },
-        post_data=list(contacts_to_add),
-    )
+    standings = get_character_standings(preston, character_id)
+    contacts_to_add = {
+        contact_id for contact_id in contacts_to_add
+        if contact_id not in standings or (
+            standings[contact_id] <= BOT_STANDING and round(standings[contact_id] * 100) != BOT_STANDING_CENTS
+        )
+    }
 
+    if not contacts_to_add:
+        return
 
-def delete_character_contacts(preston: Preston, character_id: str, contacts_to_delete: set[str]):
+    for chunk in chunks(contacts_to_add, MAX_CONTACTS_PER_POST):
+        preston.post_op(
+            'post_characters_character_id_contacts',
+            path_data={
+                "character_id": character_id,
+                "standing": BOT_STANDING,
+                "watched": False,
+            },
+            post_data=chunk,
+        )
+        for contact_id in chunk:
+            standings[contact_id] = BOT_STANDING
+
+
+def delete_character_contacts(preston: Preston, character_id: str, contacts_to_delete: set[int]):
     """Delete contacts for a character while keeping contracts not by the bot"""
-    contacts = preston.get_op(
-        "get_characters_character_id_contacts",
-        character_id=str(character_id)
-    )
+    if not contacts_to_delete:
+        return
 
-    contacts_with_wrong_standing = set(
-        str(c['contact_id']) for c in contacts if
-        c.get('standing') < BOT_STANDING - 1e-3 or c.get('standing') > BOT_STANDING + 1e-3
-    )
-    contacts_to_delete -= contacts_with_wrong_standing
+    standings = get_character_standings(preston, character_id)
+    contacts_to_delete = {
+        contact_id for contact_id in contacts_to_delete
+        if contact_id not in standings or round(standings[contact_id] * 100) == BOT_STANDING_CENTS
+    }
 
-    if len(contacts_to_delete) == 0:
+    if not contacts_to_delete:
         return
 
-    preston.delete_op(
-        "delete_characters_character_id_contacts",
-        path_data={
-            "character_id": str(character_id),
-            "contact_ids": list(contacts_to_delete),
-        },
-    )
-
+    for chunk in chunks(contacts_to_delete, MAX_CONTACTS_PER_DELETE):
+        preston.delete_op(
+            "delete_characters_character_id_contacts",
+            path_data={
+                "character_id": character_id,
+                "contact_ids": chunk,
+            },
+        )
+        for contact_id in chunk:
+            standings.pop(contact_id, None)
+
+
+def sync_character_contacts(preston: Preston, character_id: str, desired_contacts: set[int]):
+    """Make the bot's contacts of a character match the desired ones, adding missing and deleting stale ones"""
+    standings = get_character_standings(preston, character_id)
+    stale_contacts = {
+        contact_id for contact_id, standing in standings.items()
+        if round(standing * 100) == BOT_STANDING_CENTS and contact_id not in desired_contacts
+    }
+
+    add_character_contacts(preston, character_id, desired_contacts)
+    delete_character_contacts(preston, character_id, stale_contacts)
+
+
+async def update_character(preston: Preston, character: Character, update, contact_ids: set[int]):
+    """Apply a contact update to a character, flagging its token as broken if it was revoked."""
+    if not contact_ids:
+        return
 
-def remove_contact(this_character: Character, preston: Preston):
-    """Add all required contacts for a new linked character."""
     try:
-        this_char_authed_preston = preston.authenticate_from_token(this_character.token)
+        authed_preston = await call_esi(authenticate_character, preston, character)
+        await call_esi(update, authed_preston, character.character_id, contact_ids)
     except HTTPError as exp:
-        if exp.response.status_code == 401:
-            return
-        else:
+        if not token_revoked(exp):
             raise
 
-    contract_ids = set()
-
-    # Delete this contact for other characters
-    for character in Character.select().where(Character.character_id != this_character.character_id):
-        try:
-            authed_preston = preston.authenticate_from_token(character.token)
-        except HTTPError as exp:
-            if exp.response.status_code == 401:
-                continue
-            else:
-                raise
-        delete_character_contacts(authed_preston, character.character_id, {this_character.character_id})
-        contract_ids.add(character.character_id)
-
-    # Delete related contacts of this character
-    delete_character_contacts(this_char_authed_preston, this_character.character_id, contract_ids)
-
-    # Delete external contacts of this character
-    external_contract_ids = set()
-    for external_contact in ExternalContact.select():
-        external_contract_ids.add(external_contact.contact_id)
-    delete_character_contacts(this_char_authed_preston, this_character.character_id, external_contract_ids)
-
-
-def add_contact(this_character: Character, preston: Preston):
-    """Remove all required contacts for a linked character"""
-
-    # Got through registered characters and add this contact
-    character_ids = set()
-    for character in Character.select().where(Character.character_id != this_character.character_id):
-        try:
-            authed_preston = preston.authenticate_from_token(character.token)
-        except HTTPError as exp:
-            if exp.response.status_code == 401:
-                continue
-            else:
-                raise
-        add_character_contacts(authed_preston, character.character_id, {this_character.character_id})
-        character_ids.add(character.character_id)
-
-    # Add contacts to this character
+        logger.warning(f"Token of character {character.character_id} was revoked, skipping its contacts")
+        forget_character(character.character_id)
+        Character.update(token_alive=False).where(Character.character_id == character.character_id).execute()
+
+
+async def update_characters(preston: Preston, updates: list[tuple[Character, object, set[int]]]):
+    """Apply contact updates concurrently, logging failed characters instead of aborting the others."""
+    results = await asyncio.gather(
+        *[update_character(preston, character, update, contact_ids) for character, update, contact_ids in updates],
+        return_exceptions=True,
+    )
+    for (character, _, _), result in zip(updates, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to update contacts of character {character.character_id}: {result}", exc_info=result)
+
+
+async def remove_contacts(removed_characters: list[Character], preston: Preston):
+    """Remove all required contacts for linked characters, with one request per character for all of them."""
+    removed_ids = {int(character.character_id) for character in removed_characters}
+    others = list(
+        Character.select(*TOKEN_COLUMNS)
+        .where(Character.character_id.not_in([character.character_id for character in removed_characters]))
+        .namedtuples()
+    )
+    external_ids = get_external_ids()
+
+    # Delete these contacts for other characters, and related and external contacts of these characters
+    contacts_to_delete = {int(character.character_id) for character in others} | removed_ids | external_ids
+    await update_characters(preston, [
+        *[(character, delete_character_contacts, removed_ids) for character in others],
+        *[
+            (character, delete_character_contacts, contacts_to_delete - {int(character.character_id)})
+            for character in removed_characters
+        ],
+    ])
+
+    for character in removed_characters:
+        forget_character(character.character_id)
+
+
+async def add_contact(this_character: Character, preston: Preston):
+    """Add all required contacts for a new linked character."""
+    others = list(
+        Character.select(*TOKEN_COLUMNS)
+        .where(Character.character_id != this_character.character_id)
+        .namedtuples()
+    )
+    external_ids = get_external_ids()
+
+    # Add this contact to the other characters, and bring this character's own contacts in line with
+    # everyone registered at the same time, as that does not depend on the other updates
+    desired_contacts = {int(character.character_id) for character in others} | external_ids
+    await update_characters(preston, [
+        (this_character, sync_character_contacts, desired_contacts),
+        *[(character, add_character_contacts, {int(this_character.character_id)}) for character in others],
+    ])
+
+
+async def add_external_contacts(contact_ids: set[int], preston: Preston):
+    """Add external contacts to all characters, with one request per character for all of them"""
+    get_external_ids().update(contact_ids)
+
+    characters = Character.select(*TOKEN_COLUMNS).namedtuples()
+    await update_characters(preston, [(character, add_character_contacts, contact_ids) for character in characters])
+
+
+async def remove_external_contacts(contact_ids: set[int], preston: Preston):
+    """Remove external contacts from all characters, with one request per character for all of them"""
+    get_external_ids().difference_update(contact_ids)
+
+    characters = Character.select(*TOKEN_COLUMNS).namedtuples()
+    await update_characters(preston, [(character, delete_character_contacts, contact_ids) for character in characters])
+
+
+@tasks.loop()
+async def contact_worker():
+    """Run queued contact updates."""
+    job = await contact_jobs.get()
     try:
-        this_char_authed_preston = preston.authenticate_from_token(this_character.token)
-    except HTTPError as exp:
-        if exp.response.status_code == 401:
-            return
-        else:
-            raise
-    add_character_contacts(this_char_authed_preston, this_character.character_id, character_ids)
-
-    # Add external contacts to this
-    external_contract_ids = set()
-    for external_contact in ExternalContact.select():
-        external_contract_ids.add(external_contact.contact_id)
-    add_character_contacts(this_char_authed_preston, this_character.character_id, external_contract_ids)
-
-
-def add_external_contact(contact_id: str, preston: Preston):
-    """Add external contact to all characters"""
-    for character in Character.select():
-        try:
-            authed_preston = preston.authenticate_from_token(character.token)
-        except HTTPError as exp:
-            if exp.response.status_code == 401:
-                continue
-            else:
-                raise
-        add_character_contacts(authed_preston, character.character_id, {contact_id})
-
-
-def remove_external_contact(contact_id: str, preston: Preston):
-    """Add external contact to all characters"""
-    for character in Character.select():
-        try:
-            authed_preston = preston.authenticate_from_token(character.token)
-        except HTTPError as exp:
-            if exp.response.status_code == 401:
-                continue
-            else:
-                raise
-        delete_character_contacts(authed_preston, character.character_id, {contact_id})
+        await job
+    except Exception as e:
+        logger.error(f"Failed to update contacts: {e}", exc_info=True)
+    finally:
+        contact_jobs.task_done()
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+from preston import Preston
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
+
+from models import Character
+
+logger = logging.getLogger("discord.main.esi")
+
+USER_AGENT = "Contacts organizing discord bot by larynx.austrene@gmail.com"
+ESI_URL = "https://esi.evetech.net/latest"
+
+# Connection pool shared by all Preston sessions, so that connections to ESI and the SSO
+# are kept alive between calls instead of doing a new TLS handshake for every character.
+# It only retries failed connections, Preston retries error responses by itself.
+pool_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.3),
+)
+
+# Upper bound on ESI requests in flight at once, so a fan-out over many characters
+# does not burst past what ESI and the connection pool handle well
+MAX_CONCURRENT_CALLS = 10
+_call_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
+
+
+# Responses of public endpoints that are worth retrying after a pause, 420 means the ESI error limit was hit.
+# Preston already retries these for authenticated calls, so only post_public retries them.
+RETRY_STATUSES = {420, 429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+
+# ESI blocks clients for the rest of the window once too many errors happened in it,
+# so all calls pause once only this many errors are left
+ERROR_LIMIT_MARGIN = 10
+_error_limit_reset_at = 0.0
+
+
+def track_error_limit(headers):
+    """Pause all ESI calls until the error limit window resets if few errors are left in it."""
+    global _error_limit_reset_at
+    remain = headers.get("X-ESI-Error-Limit-Remain")
+    reset = headers.get("X-ESI-Error-Limit-Reset")
+    if remain is not None and reset is not None and int(remain) <= ERROR_LIMIT_MARGIN:
+        logger.warning("Only %s ESI errors left, pausing calls for %ss", remain, reset)
+        _error_limit_reset_at = max(_error_limit_reset_at, time.monotonic() + int(reset))
+
+
+def _error_limit_hook(response, *args, **kwargs):
+    track_error_limit(response.headers)
+
+
+async def _wait_for_error_limit():
+    pause = _error_limit_reset_at - time.monotonic()
+    if pause > 0:
+        await asyncio.sleep(pause)
+
+
+async def call_esi(func, *args, **kwargs):
+    """Run a blocking ESI call in a worker thread, limiting how many run at once.
+
+    Preston retries failed responses itself, so the call is not retried here.
+    """
+    await _wait_for_error_limit()
+    async with _call_semaphore:
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+
+# Session for public ESI endpoints, which need no token and so can skip Preston and its worker threads
+_http_session: aiohttp.ClientSession | None = None
+
+
+def http_session() -> aiohttp.ClientSession:
+    """Get the shared session for public ESI endpoints, creating it inside the running event loop."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        # Calls are capped by the semaphore anyway, keep that many connections alive and cache DNS lookups
+        connector = aiohttp.TCPConnector(limit_per_host=MAX_CONCURRENT_CALLS, ttl_dns_cache=300, keepalive_timeout=60)
+        _http_session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": USER_AGENT})
+    return _http_session
+
+
+async def close_http_session():
+    """Close the shared session for public ESI endpoints, if it was opened."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+async def post_public(path: str, payload):
+    """POST to a public ESI endpoint and return the decoded response, retrying transient errors."""
+    for attempt in range(MAX_ATTEMPTS):
+        await _wait_for_error_limit()
+        async with _call_semaphore:
+            async with http_session().post(
+                f"{ESI_URL}{path}", params={"datasource": "tranquility"}, json=payload
+            ) as response:
+                track_error_limit(response.headers)
+                if response.status not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+                    response.raise_for_status()
+                    return await response.json()
+                status = response.status
+
+        # Back off exponentially with some jitter, outside the semaphore so other calls can continue
+        delay = 2 ** attempt + random.random()
+        logger.warning("ESI responded with %s, retrying in %.1fs", status, delay)
+        await asyncio.sleep(delay)
+
+
+def use_pool(preston: Preston) -> Preston:
+    """Route all requests of a Preston instance through the shared connection pool."""
+    preston.session.mount("https://", pool_adapter)
+    preston.session.mount("http://", pool_adapter)
+    if _error_limit_hook not in preston.session.hooks["response"]:
+        preston.session.hooks["response"].append(_error_limit_hook)
+    return preston
+
+
+def new_preston(preston: Preston, **credentials) -> Preston:
+    """Create a Preston with other credentials that uses the shared pool and the spec preston already loaded.
+
+    Preston refreshes its access token while it is constructed, on a session without the pool,
+    so that is left to the caller once the pool is mounted.
+    """
+    created_preston = use_pool(Preston(**{**preston._kwargs, **credentials, "no_update_token": True}))
+    created_preston.spec = preston.spec
+    return created_preston
+
+
+def authenticate_from_token(preston: Preston, token: str) -> Preston:
+    """Authenticate from a refresh token, refreshing through the shared connection pool."""
+    authed_preston = new_preston(preston, refresh_token=token, access_token=None)
+    authed_preston._try_refresh_access_token()
+    return authed_preston
+
+
+# Authenticated Preston instances by character id, reused while their access token is valid
+_authenticated: dict[str, Preston] = {}
+
+
+# Seconds a stored access token has to remain valid to be used instead of refreshing it
+ACCESS_TOKEN_MARGIN = 30
+
+
+def authenticate_character(preston: Preston, character) -> Preston:
+    """Get an authenticated Preston for a character, reusing earlier instances and stored access tokens.
+
+    The token is only refreshed once no valid access token is known, so a successful return means
+    that the SSO accepted the character's token within the lifetime of an access token.
+    """
+    now = time.time()
+    authed_preston = _authenticated.get(character.character_id)
+    if authed_preston is not None:
+        if (authed_preston.access_expiration or 0) > now + ACCESS_TOKEN_MARGIN:
+            return authed_preston
+        # Refresh in place, so the instance keeps its session and uses the newest refresh token if it was rotated
+        authed_preston._try_refresh_access_token()
+    elif character.access_token and (character.access_token_expiry or 0) > now + ACCESS_TOKEN_MARGIN:
+        authed_preston = new_preston(
+            preston,
+            refresh_token=character.token,
+            access_token=character.access_token,
+            access_expiration=character.access_token_expiry,
+        )
+        _authenticated[character.character_id] = authed_preston
+        return authed_preston
+    else:
+        authed_preston = authenticate_from_token(preston, character.token)
+
+    Character.update(
+        token=authed_preston.refresh_token,
+        access_token=authed_preston.access_token,
+        access_token_expiry=authed_preston.access_expiration,
+    ).where(Character.character_id == character.character_id).execute()
+
+    _authenticated[character.character_id] = authed_preston
+    return authed_preston
+
+
+def token_revoked(exp: HTTPError) -> bool:
+    """Whether an error means that the token of a character is no longer accepted."""
+    response = exp.response
+    if response is None:
+        return False
+    if response.status_code == 401:
+        return True
+
+    # The SSO answers refreshes with a revoked or expired refresh token with 400 invalid_grant
+    return response.status_code == 400 and "invalid_grant" in response.text
+
+
+def forget_character(character_id: str):
+    """Drop the cached Preston of a character, e.g. after its token was revoked or replaced."""
+    _authenticated.pop(character_id, None)
+
+
+# Seconds a resolved name is reused, as names of characters, corporations and alliances rarely change
+NAME_CACHE_TTL = 3600
+
+_names: dict[int, tuple[float, dict]] = {}
+
+
+async def resolve_names(ids: list[int]) -> dict[int, dict]:
+    """Resolve ids to their universe/names entries, only asking ESI for ids not resolved recently."""
+    now = time.monotonic()
+    missing = {i for i in ids if i not in _names or now - _names[i][0] >= NAME_CACHE_TTL}
+    if missing:
+        results = await post_public("/universe/names/", sorted(missing))
+        for result in results:
+            _names[result["id"]] = (now, result)
+
+    return {i: _names[i][1] for i in ids if i in _names}
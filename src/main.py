@@ -1,18 +1,31 @@
+import asyncio
+import hashlib
+import json
 import logging
 import os
 import secrets
+from collections import defaultdict
+from datetime import datetime, timezone
 from typing import Literal
 
 import discord
 from discord import Interaction, app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
+from peewee import prefetch
 from preston import Preston
 from requests.exceptions import HTTPError
 
 from callback_server import callback_server
-from contacts import add_contact, remove_contact, add_external_contact, remove_external_contact
-from models import initialize_database, User, Challenge, Character, ExternalContact
-from utils import lookup, command_error_handler
+from contacts import (
+    add_contact, remove_contacts, add_external_contacts, remove_external_contacts, get_external_ids,
+    contact_jobs, contact_worker, TOKEN_COLUMNS,
+)
+from esi import (
+    USER_AGENT, use_pool, authenticate_character, forget_character, token_revoked, call_esi, resolve_names,
+    close_http_session,
+)
+from models import initialize_database, db, User, Challenge, Character, ExternalContact
+from utils import lookup, split_message, respond, command_error_handler, COMMAND_FAILED_MESSAGE
 
 # Configure the logger
 logger = logging.getLogger('discord.main')
@@ -20,135 +33,272 @@ logger.setLevel(logging.INFO)
 
 # Initialize the database
 initialize_database()
+get_external_ids()
 
 
 def token_callback(preston):
-    character_id = preston.whoami()["character_id"]
-    character = Character.get(character_id=character_id)
-    character.token = preston.refresh_token
-    character.save()
+    # Store the refreshed access token as well, so that it is still usable after a restart
+    character_data = preston.whoami()
+    if "character_id" not in character_data:
+        # whoami returns nothing if the SSO signing keys could not be fetched, skip storing instead of failing the refresh
+        logger.warning("Could not identify the character of a refreshed token")
+        return
+
+    Character.update(
+        token=preston.refresh_token,
+        character_name=character_data["character_name"],
+        access_token=preston.access_token,
+        access_token_expiry=preston.access_expiration,
+    ).where(Character.character_id == str(character_data["character_id"])).execute()
 
 
 # Setup ESI connection
-base_preston = Preston(
-    user_agent="Contacts organizing discord bot by larynx.austrene@gmail.com",
+base_preston = use_pool(Preston(
+    user_agent=USER_AGENT,
     client_id=os.environ["CCP_CLIENT_ID"],
     client_secret=os.environ["CCP_SECRET_KEY"],
     callback_url=os.environ["CCP_REDIRECT_URI"],
     scope="esi-characters.read_contacts.v1 esi-characters.write_contacts.v1",
     refresh_token_callback=token_callback,
-)
+))
+
+# The authorize URL only differs in its state, so build it once with a placeholder
+AUTHORIZE_STATE_PLACEHOLDER = "AUTHORIZE_STATE_PLACEHOLDER"
+AUTHORIZE_URL = base_preston.get_authorize_url(AUTHORIZE_STATE_PLACEHOLDER)
+
+
+async def fill_character_names(characters: list[Character]):
+    """Look up the names of characters stored without one, all in a single ESI call."""
+    nameless = [character for character in characters if character.character_name is None]
+    if not nameless:
+        return
+
+    names = await resolve_names([int(character.character_id) for character in nameless])
+    for character in nameless:
+        character.character_name = names.get(int(character.character_id), {}).get("name")
+    Character.bulk_update(nameless, fields=[Character.character_name])
+
+
+class ContactsBot(commands.Bot):
+    async def close(self):
+        """Close the shared ESI session together with the bot, so it is not left open on shutdown."""
+        await super().close()
+        await close_http_session()
+
 
 # Setup Discord
 intents = discord.Intents.default()
 intents.messages = True
 intents.message_content = True
-bot = commands.Bot(command_prefix="/", intents=intents)
+bot = ContactsBot(command_prefix="/", intents=intents)
+callback_server_task = None
+
+ADMIN_ID = int(os.environ["ADMIN"])
+
+
+def is_admin(interaction: Interaction) -> bool:
+    """Check for admin-only commands."""
+    return interaction.user.id == ADMIN_ID
+
+
+@bot.tree.error
+async def on_app_command_error(interaction: Interaction, error: app_commands.AppCommandError):
+    # Errors inside commands are answered by command_error_handler, this handles the rest such as failed checks
+    if isinstance(error, app_commands.CheckFailure):
+        await respond(interaction, "You do not have rights to use this command.")
+    else:
+        logger.error(f"Error in slash command: {error}", exc_info=error)
+        await respond(interaction, COMMAND_FAILED_MESSAGE)
+
+
+# Hash of the slash command definitions that were last synced to Discord
+COMMAND_HASH_FILE = "data/commands.sha256"
+
+
+def command_hash() -> str:
+    """Hash the current slash command definitions."""
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def log_callback_server_failure(task: asyncio.Task):
+    """Log why the callback server stopped, as nothing else awaits its task."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Callback server failed: {task.exception()}", exc_info=task.exception())
 
 
 @bot.event
 async def on_ready():
+    global callback_server_task
     logger.info(f"Logged in as {bot.user} (ID: {bot.user.id})")
-    try:
-        synced = await bot.tree.sync()
-        logger.info(f"Synced {len(synced)} slash commands.")
-    except Exception as e:
-        logger.error(f"Failed to sync commands: {e}", exc_info=True)
-    callback_server.start(base_preston, add_contact)
 
+    # Syncing is a REST call per start and reconnect, so only do it when the commands changed
+    current_command_hash = command_hash()
+    try:
+        with open(COMMAND_HASH_FILE) as f:
+            synced_command_hash = f.read().strip()
+    except FileNotFoundError:
+        synced_command_hash = None
 
-@bot.tree.command(name="info", description="Returns a list of currently registered users and characters.")
-@command_error_handler
-async def info(interaction: discord.Interaction):
-    """Returns a list of currently registered users and characters."""
-    if interaction.user.id != int(os.getenv("ADMIN")):
-        await interaction.response.send_message("You do not have rights to display all info.", ephemeral=True)
-        return
+    if current_command_hash == synced_command_hash:
+        logger.info("Slash commands unchanged, skipping sync.")
+    else:
+        try:
+            synced = await bot.tree.sync()
+            logger.info(f"Synced {len(synced)} slash commands.")
+            with open(COMMAND_HASH_FILE, "w") as f:
+                f.write(current_command_hash)
+        except Exception as e:
+            logger.error(f"Failed to sync commands: {e}", exc_info=True)
+
+    # on_ready also fires on reconnects, the callback server and worker must only be started once
+    if not contact_worker.is_running():
+        contact_worker.start()
+    if not check_tokens.is_running():
+        check_tokens.start()
+    if callback_server_task is None:
+        callback_server_task = asyncio.create_task(callback_server(base_preston, add_contact))
+        callback_server_task.add_done_callback(log_callback_server_failure)
+
+
+async def unlink_characters(characters: list[Character], user: User | None = None):
+    """Delete characters and their user if given, then queue removing their contacts."""
+    with db.atomic():
+        if characters:
+            Character.delete().where(
+                Character.character_id.in_([character.character_id for character in characters])
+            ).execute()
+
+        if user is not None:
+            Challenge.delete().where(Challenge.user == user).execute()
+            user.delete_instance()
+
+    # The loaded characters still hold their tokens, so the contacts can be removed after the rows are gone
+    if characters:
+        await contact_jobs.put(remove_contacts(characters, base_preston))
+
+
+async def check_token(character: Character) -> bool | None:
+    """Check whether the token of a character still works, None if that could not be determined."""
+    try:
+        await call_esi(authenticate_character, base_preston, character)
+    except HTTPError as exp:
+        if token_revoked(exp):
+            forget_character(character.character_id)
+            return False
+        logger.warning(f"Could not check the token of character {character.character_id}: {exp}")
+        return None
+    except Exception as exp:
+        # Connection failures, malformed tokens or an empty whoami say nothing about whether the token works
+        logger.warning(f"Could not check the token of character {character.character_id}: {exp}", exc_info=True)
+        return None
+    return True
+
+
+@tasks.loop(minutes=15)
+async def check_tokens():
+    """Check all character tokens in the background, so commands can read their state from the database."""
+    try:
+        characters = list(Character.select(*TOKEN_COLUMNS).namedtuples())
+        results = await asyncio.gather(*[check_token(character) for character in characters], return_exceptions=True)
+        checked_at = datetime.now(timezone.utc)
+
+        # Characters that could not be checked keep their last known state
+        with db.atomic():
+            for token_alive in (True, False):
+                character_ids = [
+                    character.character_id for character, result in zip(characters, results) if result is token_alive
+                ]
+                if character_ids:
+                    Character.update(token_alive=token_alive, last_checked=checked_at).where(
+                        Character.character_id.in_(character_ids)
+                    ).execute()
+    except Exception as e:
+        logger.error(f"Failed to check character tokens: {e}", exc_info=True)
 
-    await interaction.response.defer(ephemeral=True)
 
-    user_responses = []
+def info_response(users: list[User], externals: list[dict]) -> str:
+    """Build the info listing of all users and externals."""
+    lines = ["## Users"]
     dead_characters = []
-    users = User.select()
-    if not users.exists():
-        user_responses.append(f"<no users registered>")
-    else:
-        for user in users:
-            character_names = []
-            for character in user.characters:
-                try:
-                    authed_preston = base_preston.authenticate_from_token(character.token)
-                except HTTPError as exp:
-                    character_name = base_preston.get_op(
-                        "get_characters_character_id",
-                        character_id=character.character_id
-                    ).get("name")
-                    dead_characters.append(f" - {character_name}")
-                    continue
-                character_name = authed_preston.whoami()["character_name"]
-                character_names.append(f" - {character_name}")
-
-            if character_names:
-                character_names_body = "\n".join(character_names)
+    if not users:
+        lines.append("<no users registered>")
+    for user in users:
+        character_names = []
+        for character in user.characters:
+            if not character.token_alive:
+                dead_characters.append(f" - {character.character_name}")
             else:
-                character_names_body = "\n<no authorized characters>"
-            user_responses.append(f"### User <@{user.user_id}>\n{character_names_body}")
+                character_names.append(f" - {character.character_name}")
 
-    if user_responses:
-        user_responses_body = "## Users\n"
-        user_responses_body += "\n".join(user_responses)
-    else:
-        user_responses_body = "<no authorized users>"
+        lines.append(f"### User <@{user.user_id}>")
+        lines.extend(character_names or ["<no authorized characters>"])
 
     if dead_characters:
-        dead_character_response_body = "\n## Characters with broken permissions\n"
-        dead_character_response_body += "\n".join(dead_characters)
-    else:
-        dead_character_response_body = ""
+        lines.append("## Characters with broken permissions")
+        lines.extend(dead_characters)
 
     # Deal with externally linked Characters, Corporations or Alliances
-    external_response = []
-    externals = ExternalContact.select()
-    if not externals.exists():
-        external_response.append(f"<no users registered>")
+    lines.append("## Externals")
+    if not externals:
+        lines.append("<no external contacts>")
     else:
-
-        results = base_preston.post_op(
-            "post_universe_names",
-            path_data={"datasource": "tranquility"},  # Added because Preston is broken
-            post_data=[e.contact_id for e in externals],
-        )
+        externals_per_type = defaultdict(list)
+        for result in externals:
+            externals_per_type[result.get("category")].append(f" - {result.get('name')}")
 
         for external_type in ["character", "corporation", "alliance"]:
-            externals_per_type = []
-            for result in results:
-                if result.get("category") == external_type:
-                    externals_per_type.append(f" - {result.get('name')}")
+            lines.append(f"### External {external_type.capitalize()}s")
+            lines.extend(externals_per_type[external_type] or [f"<no authorized {external_type}s>"])
 
-            if externals_per_type:
-                external_type_body = "\n".join(externals_per_type)
-            else:
-                external_type_body = f"<no authorized {external_type}s>"
+    return "\n".join(lines)
 
-            external_response.append(f"### External {external_type.capitalize()}s\n{external_type_body}")
 
-    if external_response:
-        external_response_body = "\n## Externals\n"
-        external_response_body += "\n".join(external_response)
-    else:
-        external_response_body = ""
+@bot.tree.command(name="info", description="Returns a list of currently registered users and characters.")
+@app_commands.check(is_admin)
+@command_error_handler
+async def info(interaction: discord.Interaction):
+    """Returns a list of currently registered users and characters."""
+    await interaction.response.defer(ephemeral=True)
 
-    response = f"{user_responses_body}{dead_character_response_body}{external_response_body}"
+    users = prefetch(User.select(), Character.select())
+    user_characters = [character for user in users for character in user.characters]
+    external_ids = [int(contact_id) for (contact_id,) in ExternalContact.select(ExternalContact.contact_id).tuples()]
 
-    await interaction.followup.send(response, ephemeral=True)
+    # Resolve nameless characters and externals in one call, the lookups below are then served from the cache
+    nameless_ids = [int(character.character_id) for character in user_characters if character.character_name is None]
+    await resolve_names(nameless_ids + external_ids)
 
+    await fill_character_names(user_characters)
+    externals = list((await resolve_names(external_ids)).values())
 
-@bot.tree.command(name="characters", description="Displays your currently authorized characters..")
-@command_error_handler
-async def characters(interaction: discord.Interaction):
+    response = info_response(users, externals)
+    for message in split_message(response):
+        await interaction.followup.send(message, ephemeral=True)
+
+
+def characters_response(user_characters: list[Character]) -> str:
+    """Build the character listing of a user."""
     character_names = []
     dead_characters = []
 
+    for character in user_characters:
+        if not character.token_alive:
+            dead_characters.append(f"- {character.character_name}")
+        else:
+            character_names.append(f"- {character.character_name}")
+
+    lines = ["## Characters", *(character_names or ["<no authorized characters>"])]
+    if dead_characters:
+        lines.append("## Characters with broken permissions")
+        lines.extend(dead_characters)
+
+    return "\n".join(lines)
+
+
+@bot.tree.command(name="characters", description="Displays your currently authorized characters..")
+@command_error_handler
+async def characters(interaction: discord.Interaction):
     user = User.get_or_none(User.user_id == str(interaction.user.id))
     if user is None:
         await interaction.response.send_message("You are not a registered user.")
@@ -156,58 +306,33 @@ async def characters(interaction: discord.Interaction):
 
     await interaction.response.defer(ephemeral=True)
 
-    for character in user.characters:
-        try:
-            char_auth = base_preston.authenticate_from_token(character.token)
-        except HTTPError as exp:
-            if exp.response.status_code == 401:
-                dead_characters.append(character.character_id)
-                continue
-            else:
-                raise
-        character_name = char_auth.whoami()['character_name']
-        character_names.append(f"- {character_name}")
-
-    if character_names:
-        character_names_body = "## Characters"
-        character_names_body += "\n".join(character_names)
-    else:
-        character_names_body = "<no authorized characters>"
-
-    if dead_characters:
-        dead_character_response_body = "\n## Characters with broken permissions"
-        dead_character_response_body += "\n".join(dead_characters)
-    else:
-        dead_character_response_body = ""
-
-    response = f"{character_names_body}{dead_character_response_body}"
-
-    await interaction.followup.send(response, ephemeral=True)
+    user_characters = list(user.characters)
+    await fill_character_names(user_characters)
+    response = characters_response(user_characters)
+    for message in split_message(response):
+        await interaction.followup.send(message, ephemeral=True)
 
 
 @bot.tree.command(name="invite", description="Adds a user to be able to register characters.")
+@app_commands.check(is_admin)
+@command_error_handler
 async def invite(interaction: Interaction, member: discord.Member):
     """Slash command to invite a user to register characters."""
-    if interaction.user.id != int(os.getenv("ADMIN")):
-        await interaction.response.send_message("You do not have rights to invite users.")
-        return
+    await interaction.response.defer(ephemeral=True)
 
     user, created = User.get_or_create(user_id=str(member.id))
 
     if created:
-        await interaction.response.send_message(f"Invited {member.mention}.", ephemeral=True)
+        await interaction.followup.send(f"Invited {member.mention}.", ephemeral=True)
     else:
-        await interaction.response.send_message(f"{member.mention} was already invited.", ephemeral=True)
+        await interaction.followup.send(f"{member.mention} was already invited.", ephemeral=True)
 
 
 @bot.tree.command(name="kick", description="Removes a user and their characters from contacts.")
+@app_commands.check(is_admin)
 @command_error_handler
 async def kick(interaction: Interaction, member: discord.Member):
     """Slash command to remove a user and their characters from the system."""
-    if interaction.user.id != int(os.getenv("ADMIN")):
-        await interaction.response.send_message("You do not have rights to kick users.")
-        return
-
     await interaction.response.defer(ephemeral=True)
 
     user = User.get_or_none(User.user_id == str(member.id))
@@ -215,47 +340,39 @@ async def kick(interaction: Interaction, member: discord.Member):
         await interaction.followup.send("User not found.", ephemeral=True)
         return
 
-    removed_character_names = []
-    for character in user.characters:
-        remove_contact(character, base_preston)
-        try:
-            char_auth = base_preston.authenticate_from_token(character.token)
-        except HTTPError as exp:
-            if exp.response.status_code == 401:
-                await interaction.followup.send("ESI permissions broken.", ephemeral=True)
-                return
-            else:
-                raise
-        character_name = char_auth.whoami()['character_name']
-        character.delete_instance()
-        removed_character_names.append(character_name)
-
-    user.delete_instance()
+    removed_characters = list(user.characters)
+    await fill_character_names(removed_characters)
+    removed_character_names = [character.character_name for character in removed_characters]
+    await unlink_characters(removed_characters, user)
 
-    response = f"Removed the user <@{member.id}> and their characters:\n"
-    for character_name in removed_character_names:
-        response += f" - {character_name}\n"
+    response = f"Removing the user <@{member.id}> and their characters:\n" + "\n".join(
+        f" - {removed_character_name}" for removed_character_name in removed_character_names
+    )
 
-    await interaction.followup.send(response, ephemeral=True)
+    for message in split_message(response):
+        await interaction.followup.send(message, ephemeral=True)
 
 
 @bot.tree.command(name="auth", description="Sends you an authorization link for characters.")
 @command_error_handler
 async def auth(interaction: Interaction):
+    await interaction.response.defer(ephemeral=True)
     secret_state = secrets.token_urlsafe(60)
 
     user = User.get_or_none(user_id=str(interaction.user.id))
     if user is None:
-        await interaction.response.send_message(
-            f"You do not have access to this bot, contact <@{os.getenv('ADMIN')}> so he allows you to register characters."
+        await interaction.followup.send(
+            f"You do not have access to this bot, contact <@{ADMIN_ID}> so he allows you to register characters.",
+            ephemeral=True
         )
         return
 
-    Challenge.delete().where(Challenge.user == user).execute()
-    Challenge.create(user=user, state=secret_state)
+    Challenge.insert(user=user, state=secret_state).on_conflict(
+        conflict_target=[Challenge.user], update={Challenge.state: secret_state}
+    ).execute()
 
-    full_link = f"{base_preston.get_authorize_url(secret_state)}"
-    await interaction.response.send_message(
+    full_link = AUTHORIZE_URL.replace(AUTHORIZE_STATE_PLACEHOLDER, secret_state)
+    await interaction.followup.send(
         f"Use this [authentication link]({full_link}) to authorize your characters.", ephemeral=True)
 
 
@@ -273,24 +390,19 @@ async def revoke(interaction: Interaction, character_name: str | None = None):
     user = User.get_or_none(User.user_id == str(interaction.user.id))
 
     if user is None:
-        await interaction.followup.defer(f"You did not have any authorized characters in the first place.")
+        await interaction.followup.send(f"You did not have any authorized characters in the first place.", ephemeral=True)
         return
 
     if character_name is None:
 
-        user_characters = Character.select().where(Character.user == user)
-        if user_characters:
-            for character in user_characters:
-                remove_contact(character, base_preston)
-                character.delete_instance()
-
-        user.delete_instance()
-        await interaction.followup.send(f"Successfully revoked access to all your characters.", ephemeral=True)
+        user_characters = list(Character.select().where(Character.user == user))
+        await unlink_characters(user_characters, user)
+        await interaction.followup.send(f"Revoking access to all your characters.", ephemeral=True)
         return
 
     else:
         try:
-            character_id = await lookup(base_preston, character_name, return_type="characters")
+            character_id = await lookup(character_name, return_type="characters")
         except ValueError:
             await interaction.followup.send(f"Args `{character_name}` could not be parsed or looked up.")
             return
@@ -299,9 +411,8 @@ async def revoke(interaction: Interaction, character_name: str | None = None):
             await interaction.followup.send("You have no character with that name linked.")
             return
 
-        remove_contact(character, base_preston)
-        character.delete_instance()
-        await interaction.followup.send(f"Successfully removed {character_name}.", ephemeral=True)
+        await unlink_characters([character])
+        await interaction.followup.send(f"Removing {character_name}.", ephemeral=True)
 
 
 @bot.tree.command(
@@ -312,6 +423,7 @@ async def revoke(interaction: Interaction, character_name: str | None = None):
     entity_type="Type of entity to add.",
     entity_name="Name of the character, corporation, or alliance to add."
 )
+@app_commands.check(is_admin)
 @command_error_handler
 async def add_external(
         interaction: Interaction,
@@ -320,12 +432,8 @@ async def add_external(
 ):
     await interaction.response.defer(ephemeral=True)
 
-    if not interaction.user.id == int(os.getenv("ADMIN")):
-        await interaction.followup.send(f"You do not have rights to add external contacts.")
-        return
-
     try:
-        contact_id = await lookup(base_preston, entity_name, return_type=entity_type + "s")
+        contact_id = await lookup(entity_name, return_type=entity_type + "s")
     except ValueError:
         await interaction.followup.send(f"Args `{entity_name}` could not be parsed or looked up.")
         return
@@ -334,12 +442,17 @@ async def add_external(
         contact_id=contact_id,
     )
 
-    add_external_contact(contact_id, base_preston)
+    await contact_jobs.put(add_external_contacts({contact_id}, base_preston))
+    character_count = Character.select().count()
 
     if created:
-        await interaction.followup.send(f"Successfully added {entity_name} as a contact.", ephemeral=True)
+        await interaction.followup.send(
+            f"Adding {entity_name} as a contact for {character_count} characters.", ephemeral=True
+        )
     else:
-        await interaction.followup.send(f"Successfully re-added {entity_name} as a contact.", ephemeral=True)
+        await interaction.followup.send(
+            f"Re-adding {entity_name} as a contact for {character_count} characters.", ephemeral=True
+        )
 
 
 @bot.tree.command(
@@ -350,6 +463,7 @@ async def add_external(
     entity_type="Type of entity to remove.",
     entity_name="Name of the character, corporation, or alliance to remove."
 )
+@app_commands.check(is_admin)
 @command_error_handler
 async def remove_external(
         interaction: Interaction,
@@ -358,12 +472,8 @@ async def remove_external(
 ):
     await interaction.response.defer(ephemeral=True)
 
-    if not interaction.user.id == int(os.getenv("ADMIN")):
-        await interaction.followup.send(f"You do not have rights to add external contacts.")
-        return
-
     try:
-        contact_id = await lookup(base_preston, entity_name, return_type=entity_type + "s")
+        contact_id = await lookup(entity_name, return_type=entity_type + "s")
     except ValueError:
         await interaction.followup.send(f"Args `{entity_name}` could not be parsed or looked up.")
         return
@@ -378,10 +488,13 @@ async def remove_external(
         )
         return
 
-    remove_external_contact(contact_id, base_preston)
-
     contact.delete_instance()
-    await interaction.followup.send(f"Successfully removed {entity_name}.", ephemeral=True)
+    await contact_jobs.put(remove_external_contacts({contact_id}, base_preston))
+    character_count = Character.select().count()
+
+    await interaction.followup.send(
+        f"Removing {entity_name} as a contact from {character_count} characters.", ephemeral=True
+    )
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
 # Initialize the database
 db = SqliteDatabase('data/bot.db')
@@ -17,6 +18,11 @@ class Character(BaseModel):
     character_id = CharField(primary_key=True)
     user = ForeignKeyField(User, backref='characters')
     token = TextField()
+    character_name = CharField(null=True)
+    access_token = TextField(null=True)
+    access_token_expiry = FloatField(null=True)
+    token_alive = BooleanField(default=True)
+    last_checked = DateTimeField(null=True)
 
 
 class ExternalContact(BaseModel):
@@ -24,10 +30,40 @@ class ExternalContact(BaseModel):
 
 
 class Challenge(BaseModel):
-    user = ForeignKeyField(User, backref='challenges')
+    user = ForeignKeyField(User, backref='challenges', unique=True)
     state = CharField()
 
 
+MODELS = [User, Character, ExternalContact, Challenge]
+
+
+def migrate_database():
+    """Add columns that were introduced after the tables were first created."""
+    migrator = SqliteMigrator(db)
+    operations = []
+    for model in MODELS:
+        table = model._meta.table_name
+        existing_columns = {column.name for column in db.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            if field.column_name not in existing_columns:
+                operations.append(migrator.add_column(table, field.column_name, field))
+
+    if operations:
+        migrate(*operations)
+
+    # Challenges used to be deleted and recreated, now they are replaced in place per user
+    challenge_table = Challenge._meta.table_name
+    user_indexes = [index for index in db.get_indexes(challenge_table) if index.columns == ["user_id"]]
+    if not any(index.unique for index in user_indexes):
+        # Pending logins are short-lived, so drop them instead of deduplicating
+        Challenge.delete().execute()
+        migrate(
+            *[migrator.drop_index(challenge_table, index.name) for index in user_indexes],
+            migrator.add_index(challenge_table, ("user_id",), True),
+        )
+
+
 def initialize_database():
     with db:
-        db.create_tables([User, Character, ExternalContact, Challenge])
+        db.create_tables(MODELS)
+        migrate_database()
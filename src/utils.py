@@ -1,12 +1,15 @@
+import asyncio
 import logging
 
-from preston import Preston
+import aiohttp
+
+from esi import post_public
 
 logger = logging.getLogger("discord.main.utils")
 import functools
 
 
-async def lookup(preston, string, return_type):
+async def lookup(string, return_type):
     """Tries to find an ID related to the input.
 
     Parameters
@@ -19,33 +22,69 @@ async def lookup(preston, string, return_type):
 
     Raises
     ------
-    ValueError if the name can't be resolved
+    ValueError if the name can't be resolved, also when ESI can't be reached
     """
     try:
         return int(string)
     except ValueError:
         try:
-            result = preston.post_op(
-                'post_universe_ids',
-                path_data={},
-                post_data=[string]
-            )
+            result = await post_public("/universe/ids/", [string])
             return int(max(result[return_type], key=lambda x: x["id"])["id"])
         except (ValueError, KeyError):
             raise ValueError("Could not parse that character!")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Failed to look up %s: %s", string, e)
+            raise ValueError("Could not look up that character!")
+
+
+# Discord rejects messages longer than 2000 characters
+MESSAGE_LIMIT = 2000
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """Split a response into messages within Discord's length limit, breaking between lines."""
+    messages = []
+    current = []
+    current_length = 0
+    for line in text.split("\n"):
+        line = line[:limit]
+        if current and current_length + 1 + len(line) > limit:
+            messages.append("\n".join(current))
+            current = []
+            current_length = 0
+        current_length += len(line) + (1 if current else 0)
+        current.append(line)
+
+    messages.append("\n".join(current))
+    return messages
+
+
+COMMAND_FAILED_MESSAGE = "Something went wrong, please try again later."
+
+
+async def respond(interaction, message: str):
+    """Answer an interaction, with a followup if it was already deferred or answered."""
+    if interaction.response.is_done():
+        await interaction.followup.send(message, ephemeral=True)
+    else:
+        await interaction.response.send_message(message, ephemeral=True)
 
 
 def command_error_handler(func):
     """Decorator for handling bot command logging and exceptions."""
 
+    command_name = func.__name__
+
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
         interaction, *arguments = args
-        logger.info(f"{interaction.user.name} used /{func.__name__} {arguments} {kwargs}")
+        logger.info("%s used /%s %s %s", interaction.user.name, command_name, arguments, kwargs)
 
         try:
             return await func(*args, **kwargs)
         except Exception as e:
-            logger.error(f"Error in /{func.__name__} command: {e}", exc_info=True)
+            logger.error("Error in /%s command: %s", command_name, e, exc_info=True)
+            # Without an answer a deferred interaction keeps showing that the bot is thinking
+            await respond(interaction, COMMAND_FAILED_MESSAGE)
 
     return wrapper